@@ -1,4 +1,6 @@
-import os, json, sys
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+import os, sys
 # allow relative import from a parent directory
 # nb: this isn't required if you pip install wsk
 sys.path.insert(1, os.path.join(sys.path[0], '..'))
@@ -18,21 +20,29 @@ token = session.authenticate(username=user, password=pw)
 # find all sources available to account
 all_sources = session.get_all_sources()
 
-# find all sources that contain 'times' in their titles
-times_sources = session.search_sources(query='times')
-
-# get the included and excluded publication titles for a source id
-source_details = session.get_source_details(source_id=8399)
-
-# run a query for a keyword within a given source id
-results = []
-for result_packet in session.search(
+# these lookups are independent, so run them concurrently over the
+# session's shared connection pool
+with ThreadPoolExecutor(max_workers=2) as executor:
+  # find all sources that contain 'times' in their titles
+  times_sources = executor.submit(session.search_sources, query='times')
+  # get the included and excluded publication titles for a source id
+  source_details = executor.submit(session.get_source_details, source_id=8399)
+  times_sources = times_sources.result()
+  source_details = source_details.result()
+
+# run a query for a keyword within a given source id over four days,
+# searching each day concurrently. Each yielded packet is a page of
+# results; chain them into a single list
+results = list(chain.from_iterable(session.search(
   query='checkers',
   source_id=8399,
   start_date='2017-08-01',
-  end_date='2017-08-02',
+  end_date='2017-08-05',
+  workers=4,
   yield_results=True,
-  save_results=False):
-  results += list(result_packet) if result_packet else []
+  save_results=False)))
 
 print(' * found the following results', results)
+
+# save any buffered results and close the session's connections
+session.close()
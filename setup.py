@@ -10,8 +10,9 @@ setup (
   author_email='douglas.duhaime@gmail.com',
   license='MIT',
   install_requires=[
-    'beautifulsoup4>=4.5.1',
-    'pymongo>=3.3.1',
-    'requests>=2.20.0'
+    'lxml>=4.9.0',
+    'pymongo[zstd]>=4.6.0',
+    'requests>=2.20.0',
+    'urllib3>=1.26.0'
   ],
 )
\ No newline at end of file
@@ -0,0 +1,55 @@
+import binascii
+import unittest
+
+from wsk.wsk import document_payloads
+
+
+def response(*containers):
+  '''
+  @param {str} containers: the inner xml of each documentContainer
+  @returns {bytes}: a GetDocumentsByDocumentId response with the containers
+  '''
+  return ('<?xml version="1.0" encoding="UTF-8"?>'
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/">'
+    '<soapenv:Body><ns2:GetDocumentsByDocumentIdResponse xmlns:ns2="http://r" '
+    'xmlns:ns1="http://d"><ns1:documentContainerList>' +
+    ''.join('<ns1:documentContainer>%s</ns1:documentContainer>' % i
+      for i in containers) +
+    '</ns1:documentContainerList></ns2:GetDocumentsByDocumentIdResponse>'
+    '</soapenv:Body></soapenv:Envelope>').encode('utf8')
+
+
+def container(doc_id, document, reverse=False):
+  '''
+  @param {str} doc_id: the document's id
+  @param {str} document: the document's base64 body
+  @param {bool} reverse: if True, list the document before its id
+  @returns {str}: the inner xml of a documentContainer
+  '''
+  fields = ['<ns1:documentId>%s</ns1:documentId>' % doc_id,
+    '<ns1:document>%s</ns1:document>' % document]
+  return ''.join(reversed(fields) if reverse else fields)
+
+
+class DocumentPayloadsTest(unittest.TestCase):
+
+  def test_ordered_containers(self):
+    content = response(container('A1', 'QUE='), container('B2', 'QkI='))
+    self.assertEqual(document_payloads(content, ['A1', 'B2']),
+      [('A1', b'QUE='), ('B2', b'QkI=')])
+
+  def test_partially_reordered_containers(self):
+    content = response(container('A1', 'QUE='),
+      container('B2', 'QkI=', reverse=True))
+    self.assertEqual(document_payloads(content, ['A1', 'B2']),
+      [('A1', b'QUE='), ('B2', b'QkI=')])
+
+  def test_escaped_payload(self):
+    content = response(container('A1', 'QU&#13;E='))
+    payloads = document_payloads(content, ['A1'])
+    self.assertEqual(payloads, [('A1', b'QU\rE=')])
+    self.assertEqual(binascii.a2b_base64(payloads[0][1]), b'AA')
+
+
+if __name__ == '__main__':
+  unittest.main()